@@ -3,17 +3,29 @@
 __credits__ = ['David Dale', 'Daniil Moskovskiy', 'Dmitry Ustalov']
 
 import argparse
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from functools import partial
-from typing import Optional, Type, Tuple, Dict, Callable, List, Union
+from typing import Optional, Type, Tuple, Dict, Callable, Hashable, List, Sequence, TypeVar, Union, cast
 
 import numpy as np
 import numpy.typing as npt
 import pandas as pd
 import torch
 from sacrebleu import CHRF
-from tqdm.auto import trange
-from transformers import AutoModelForSequenceClassification, AutoTokenizer
+from tqdm.auto import tqdm
+from transformers import (AutoModelForSequenceClassification, AutoTokenizer, BatchEncoding, PreTrainedModel,
+                          PreTrainedTokenizerBase)
+
+os.environ.setdefault('TOKENIZERS_PARALLELISM', 'true')
+
+PADDING_BUCKETS = (32, 64, 128, 256, 512)
+
+CHRF_PARALLEL_MIN_TEXTS = 20000
+CHRF_MAX_WORKERS = 8
+
+T = TypeVar('T', bound=Hashable)
 
 
 def prepare_target_label(model: AutoModelForSequenceClassification, target_label: Union[int, str]) -> int:
@@ -29,45 +41,94 @@ def prepare_target_label(model: AutoModelForSequenceClassification, target_label
     return target_label
 
 
+def tokenize_texts(
+        tokenizer: AutoTokenizer,
+        texts: List[str],
+        second_texts: Optional[List[str]] = None
+) -> BatchEncoding:
+    inputs = [texts]
+
+    if second_texts is not None:
+        inputs.append(second_texts)
+
+    encodings: BatchEncoding = tokenizer(*inputs, truncation=True, max_length=PADDING_BUCKETS[-1])
+    return encodings
+
+
+def model_device(model: AutoModelForSequenceClassification) -> torch.device:
+    device: torch.device = model.device
+    return device
+
+
 def classify_texts(
         model: AutoModelForSequenceClassification,
         tokenizer: AutoTokenizer,
         texts: List[str],
         target_label: Union[int, str],
         second_texts: Optional[List[str]] = None,
-        batch_size: int = 32,
+        batch_size: int = 128,
         raw_logits: bool = False,
-        desc: Optional[str] = None
+        desc: Optional[str] = None,
+        encodings: Optional[BatchEncoding] = None,
+        pad_to_buckets: bool = False
 ) -> npt.NDArray[np.float64]:
     target_label = prepare_target_label(model, target_label)
 
-    res = []
+    if encodings is None:
+        encodings = tokenize_texts(tokenizer, texts, second_texts)
+
+    device = model_device(model)
+    scores = torch.zeros(len(texts), device=device)
+    i = 0
+
+    with tqdm(total=len(texts), desc=desc, mininterval=1.0, disable=None) as progress:
+        while i < len(texts):
+            end = min(i + batch_size, len(texts))
+            batch = {key: values[i: end] for key, values in encodings.items()}
+            max_length: Optional[int] = None
+
+            if pad_to_buckets:
+                longest = max(len(input_ids) for input_ids in batch['input_ids'])
+                bucket = next(size for size in PADDING_BUCKETS if size >= longest)
+                max_positions: int = cast(PreTrainedModel, model).config.max_position_embeddings
+                max_length = max(longest, min(bucket, max_positions))
+
+            inputs = cast(PreTrainedTokenizerBase, tokenizer).pad(
+                batch, padding='longest' if max_length is None else 'max_length', max_length=max_length,
+                return_tensors="pt"
+            )
+
+            if device.type == 'cuda':
+                inputs = BatchEncoding(
+                    {key: value.pin_memory().to(device, non_blocking=True) for key, value in inputs.items()}
+                )
+            else:
+                inputs = inputs.to(device)
 
-    for i in trange(0, len(texts), batch_size, desc=desc):
-        inputs = [texts[i: i + batch_size]]
+            try:
+                with torch.inference_mode():
+                    logits = model(**inputs).logits.float()
+                    if raw_logits:
+                        preds = logits[:, target_label]
+                    elif logits.shape[-1] > 1:
+                        preds = torch.softmax(logits, -1)[:, target_label]
+                    else:
+                        preds = torch.sigmoid(logits)[:, 0]
+                    scores[i: end] = preds
+            except torch.cuda.OutOfMemoryError:
+                del inputs
+                torch.cuda.empty_cache()
 
-        if second_texts is not None:
-            inputs.append(second_texts[i: i + batch_size])
-        inputs = tokenizer(
-            *inputs, return_tensors="pt", padding=True, truncation=True, max_length=512,
-        ).to(model.device)
+                if batch_size > 1:
+                    batch_size //= 2
+                    continue
 
-        with torch.no_grad():
-            try:
-                logits = model(**inputs).logits
-                if raw_logits:
-                    preds = logits[:, target_label]
-                elif logits.shape[-1] > 1:
-                    preds = torch.softmax(logits, -1)[:, target_label]
-                else:
-                    preds = torch.sigmoid(logits)[:, 0]
-                preds = preds.cpu().numpy()
-            except:
-                print(i, i + batch_size)
-                preds = [0] * len(inputs)
-        res.append(preds)
-
-    return np.concatenate(res)
+                print(f'Out of memory on text {i}, its score is set to zero', file=sys.stderr)
+
+            progress.update(end - i)
+            i = end
+
+    return scores.cpu().numpy()
 
 
 def evaluate_style(
@@ -75,7 +136,9 @@ def evaluate_style(
         tokenizer: AutoTokenizer,
         texts: List[str],
         target_label: int = 1,  # 1 is formal, 0 is informal
-        batch_size: int = 32
+        batch_size: int = 128,
+        encodings: Optional[BatchEncoding] = None,
+        pad_to_buckets: bool = False
 ) -> npt.NDArray[np.float64]:
     target_label = prepare_target_label(model, target_label)
     scores = classify_texts(
@@ -84,7 +147,9 @@ def evaluate_style(
         texts,
         target_label,
         batch_size=batch_size,
-        desc='Style'
+        desc='Style',
+        encodings=encodings,
+        pad_to_buckets=pad_to_buckets
     )
     return scores
 
@@ -96,8 +161,9 @@ def evaluate_meaning(
         rewritten_texts: List[str],
         target_label: str = "entailment",
         bidirectional: bool = True,
-        batch_size: int = 32,
+        batch_size: int = 128,
         aggregation: str = "prod",
+        pad_to_buckets: bool = False
 ) -> npt.NDArray[np.float64]:
     prepared_target_label = prepare_target_label(model, target_label)
 
@@ -108,7 +174,8 @@ def evaluate_meaning(
         prepared_target_label,
         rewritten_texts,
         batch_size=batch_size,
-        desc='Meaning'
+        desc='Meaning',
+        pad_to_buckets=pad_to_buckets
     )
     if bidirectional:
         reverse_scores = classify_texts(
@@ -118,7 +185,8 @@ def evaluate_meaning(
             prepared_target_label,
             original_texts,
             batch_size=batch_size,
-            desc='Meaning'
+            desc='Meaning',
+            pad_to_buckets=pad_to_buckets
         )
         if aggregation == "prod":
             scores = reverse_scores * scores
@@ -136,7 +204,9 @@ def evaluate_cola(
         tokenizer: AutoTokenizer,
         texts: List[str],
         target_label: int = 1,
-        batch_size: int = 32
+        batch_size: int = 128,
+        encodings: Optional[BatchEncoding] = None,
+        pad_to_buckets: bool = False
 ) -> npt.NDArray[np.float64]:
     target_label = prepare_target_label(model, target_label)
     scores = classify_texts(
@@ -145,63 +215,139 @@ def evaluate_cola(
         texts,
         target_label,
         batch_size=batch_size,
-        desc='Fluency'
+        desc='Fluency',
+        encodings=encodings,
+        pad_to_buckets=pad_to_buckets
     )
     return scores
 
 
+def chrf_sentence_score(hypothesis: str, reference: str) -> float:
+    score: float = CHRF().sentence_score(hypothesis, [reference]).score
+    return score
+
+
+def unique_by_length(items: Sequence[T], length: Callable[[T], int]) -> Tuple[List[T], npt.NDArray[np.intp]]:
+    positions: Dict[T, int] = {}
+    index = np.fromiter(
+        (positions.setdefault(item, len(positions)) for item in items), dtype=np.intp, count=len(items)
+    )
+    unique = list(positions)
+
+    order = np.argsort([length(item) for item in unique], kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+
+    return [unique[i] for i in order], rank[index]
+
+
+def run_on_stream(
+        evaluator: Callable[[], npt.NDArray[np.float64]],
+        device: torch.device
+) -> npt.NDArray[np.float64]:
+    with torch.cuda.stream(torch.cuda.Stream(device=device)):  # type: ignore[no-untyped-call]
+        return evaluator()
+
+
 def evaluate_style_transfer(
-        original_texts: List[str],
-        rewritten_texts: List[str],
+        original_texts: Sequence[str],
+        rewritten_texts: Sequence[str],
         style_model: AutoModelForSequenceClassification,
         style_tokenizer: AutoTokenizer,
         meaning_model: AutoModelForSequenceClassification,
         meaning_tokenizer: AutoTokenizer,
         fluency_model: AutoModelForSequenceClassification,
         fluency_tokenizer: AutoTokenizer,
-        references: Optional[List[str]] = None,
+        references: Optional[Sequence[str]] = None,
         style_target_label: int = 1,
         meaning_target_label: str = "paraphrase",
         cola_target_label: int = 1,
-        batch_size: int = 32
+        batch_size: int = 128,
+        concurrent: bool = False,
+        pad_to_buckets: bool = False
 ) -> Dict[str, npt.NDArray[np.float64]]:
-    accuracy = evaluate_style(
+    # identical texts are scored once, in order of length
+    sorted_rewritten_texts, rewritten_index = unique_by_length(rewritten_texts, len)
+    sorted_pairs, pair_index = unique_by_length(
+        list(zip(original_texts, rewritten_texts)), lambda pair: len(pair[0]) + len(pair[1])
+    )
+    sorted_original_texts = [original for original, _ in sorted_pairs]
+    sorted_paired_texts = [rewritten for _, rewritten in sorted_pairs]
+
+    # the rewritten texts are encoded only once when the style and fluency models share a tokenizer
+    style_encodings = tokenize_texts(style_tokenizer, sorted_rewritten_texts)
+
+    if fluency_tokenizer is style_tokenizer:
+        fluency_encodings = style_encodings
+    else:
+        fluency_encodings = tokenize_texts(fluency_tokenizer, sorted_rewritten_texts)
+
+    style_evaluator = partial(
+        evaluate_style,
         style_model,
         style_tokenizer,
-        rewritten_texts,
+        sorted_rewritten_texts,
         target_label=style_target_label,
         batch_size=batch_size,
+        encodings=style_encodings,
+        pad_to_buckets=pad_to_buckets,
     )
 
-    similarity = evaluate_meaning(
+    meaning_evaluator = partial(
+        evaluate_meaning,
         meaning_model,
         meaning_tokenizer,
-        original_texts,
-        rewritten_texts,
+        sorted_original_texts,
+        sorted_paired_texts,
         batch_size=batch_size,
         bidirectional=False,
         target_label=meaning_target_label,
+        pad_to_buckets=pad_to_buckets,
     )
 
-    fluency = evaluate_cola(
+    fluency_evaluator = partial(
+        evaluate_cola,
         fluency_model,
         fluency_tokenizer,
-        texts=rewritten_texts,
+        texts=sorted_rewritten_texts,
         batch_size=batch_size,
         target_label=cola_target_label,
+        encodings=fluency_encodings,
+        pad_to_buckets=pad_to_buckets,
     )
 
+    evaluators = (style_evaluator, meaning_evaluator, fluency_evaluator)
+    devices = [model_device(model) for model in (style_model, meaning_model, fluency_model)]
+
+    if concurrent and all(device.type == 'cuda' for device in devices):
+        with ThreadPoolExecutor(max_workers=len(evaluators)) as executor:
+            futures = [
+                executor.submit(run_on_stream, evaluator, device) for evaluator, device in zip(evaluators, devices)
+            ]
+            accuracy, similarity, fluency = (future.result() for future in futures)
+
+        torch.cuda.synchronize()
+    else:
+        accuracy, similarity, fluency = (evaluator() for evaluator in evaluators)
+
+    accuracy, similarity, fluency = accuracy[rewritten_index], similarity[pair_index], fluency[rewritten_index]
+
     joint = accuracy * similarity * fluency
 
     result = {'accuracy': accuracy, 'similarity': similarity, 'fluency': fluency, 'joint': joint}
 
     if references is not None:
-        chrf = CHRF()
-
-        result['chrf'] = np.array([
-            chrf.sentence_score(hypothesis, [reference]).score
-            for hypothesis, reference in zip(rewritten_texts, references)
-        ], dtype=np.float64)
+        if len(rewritten_texts) < CHRF_PARALLEL_MIN_TEXTS:
+            result['chrf'] = np.fromiter(
+                map(chrf_sentence_score, rewritten_texts, references),
+                dtype=np.float64, count=len(rewritten_texts)
+            )
+        else:
+            with ProcessPoolExecutor(max_workers=min(CHRF_MAX_WORKERS, os.cpu_count() or 1)) as executor:
+                result['chrf'] = np.fromiter(
+                    executor.map(chrf_sentence_score, rewritten_texts, references, chunksize=64),
+                    dtype=np.float64, count=len(rewritten_texts)
+                )
 
     return result
 
@@ -211,22 +357,33 @@ def load_model(
         model: Optional[AutoModelForSequenceClassification] = None,
         tokenizer: Optional[AutoTokenizer] = None,
         model_class: Type[AutoModelForSequenceClassification] = AutoModelForSequenceClassification,
-        use_cuda: bool = True
+        use_cuda: bool = True,
+        compile_model: bool = False,
+        torch_dtype: Optional[torch.dtype] = None
 ) -> Tuple[AutoModelForSequenceClassification, AutoTokenizer]:
     if model is None:
         if model_name is None:
             raise ValueError("Either model or model_name should be provided")
 
-        model = model_class.from_pretrained(model_name)
+        kwargs = {} if torch_dtype is None else {'torch_dtype': torch_dtype}
+
+        try:
+            model = model_class.from_pretrained(model_name, attn_implementation='sdpa', **kwargs)
+        except (ImportError, ValueError):
+            model = model_class.from_pretrained(model_name, **kwargs)
 
         if torch.cuda.is_available() and use_cuda:
             model.cuda()
 
+            if compile_model:
+                compiled = torch.compile(cast(torch.nn.Module, model), mode='reduce-overhead', fullgraph=False)
+                model = cast(AutoModelForSequenceClassification, compiled)
+
     if tokenizer is None:
         if model_name is None:
             raise ValueError("Either tokenizer or model_name should be provided")
 
-        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
 
     return model, tokenizer
 
@@ -259,12 +416,12 @@ def run_evaluation(
     assert len(df) == len(df_input) == len(df_prediction) == len(df_references), \
         f'Dataset lengths {len(df_input)} & {len(df_prediction)} & {len(df_references)} != {len(df)}'
 
-    assert not df.isna().values.any(), 'Datasets contain missing entries'
+    assert not df.isna().any().any(), 'Datasets contain missing entries'
 
     result = evaluator(
-        original_texts=df['input'].tolist(),
-        rewritten_texts=df['prediction'].tolist(),
-        references=df['reference'].tolist()
+        original_texts=tuple(df['input']),
+        rewritten_texts=tuple(df['prediction']),
+        references=tuple(df['reference'])
     )
 
     aggregated = {measure: np.mean(values).item() for measure, values in result.items()}
@@ -290,16 +447,33 @@ def main() -> None:
                         help='Meaning evaluation model on Hugging Face Hub')
     parser.add_argument('--fluency-model', type=str, required=True,
                         help='Fluency evaluation model on Hugging Face Hub')
+    parser.add_argument('--batch-size', type=int, default=128,
+                        help='Initial batch size; it is halved whenever a batch runs out of GPU memory')
     parser.add_argument('--no-cuda', action='store_true', default=False,
                         help='Disable the use of CUDA')
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help='Compile the models with torch.compile (CUDA only)')
+    parser.add_argument('--concurrent-eval', action='store_true', default=False,
+                        help='Run the three evaluation models concurrently on separate CUDA streams')
+    parser.add_argument('--half-precision', action='store_true', default=False,
+                        help='Load the models in bfloat16 or float16 (CUDA only); the scores will differ slightly')
     parser.add_argument('prediction', type=argparse.FileType('rb'),
                         help='Your model predictions')
 
     args = parser.parse_args()
 
-    style_model, style_tokenizer = load_model(args.style_model, use_cuda=not args.no_cuda)
-    meaning_model, meaning_tokenizer = load_model(args.meaning_model, use_cuda=not args.no_cuda)
-    fluency_model, fluency_tokenizer = load_model(args.fluency_model, use_cuda=not args.no_cuda)
+    use_cuda = torch.cuda.is_available() and not args.no_cuda
+    torch_dtype = None
+
+    if args.half_precision and use_cuda:
+        torch_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+
+    style_model, style_tokenizer = load_model(args.style_model, use_cuda=not args.no_cuda,
+                                              compile_model=args.compile, torch_dtype=torch_dtype)
+    meaning_model, meaning_tokenizer = load_model(args.meaning_model, use_cuda=not args.no_cuda,
+                                                  compile_model=args.compile, torch_dtype=torch_dtype)
+    fluency_model, fluency_tokenizer = load_model(args.fluency_model, use_cuda=not args.no_cuda,
+                                                  compile_model=args.compile, torch_dtype=torch_dtype)
 
     run_evaluation(args, evaluator=partial(
         evaluate_style_transfer,
@@ -311,7 +485,10 @@ def main() -> None:
         fluency_tokenizer=fluency_tokenizer,
         style_target_label=0,
         meaning_target_label=0,
-        cola_target_label=0
+        cola_target_label=0,
+        batch_size=args.batch_size,
+        concurrent=args.concurrent_eval,
+        pad_to_buckets=args.compile and use_cuda
     ))
 
 
@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 
 import argparse
-from os.path import exists
-from glob import glob
-from os.path import isdir
-from sklearn.metrics import balanced_accuracy_score, precision_score, recall_score, f1_score
-import json
+import os
+import sys
+from stat import S_ISDIR
+from sklearn.metrics import precision_score, recall_score, f1_score
+import numpy as np
 from nltk.translate.bleu_score import sentence_bleu
 from nltk.tokenize import word_tokenize
 from nltk.corpus import stopwords
@@ -13,37 +13,52 @@ import string
 from bert_score import score
 import subprocess
 import tempfile
-from copy import deepcopy
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+_ERR_PREFIX = '  [\033[91mx\033[0m] '
+_OK_PREFIX = '  [\033[92mo\033[0m] '
 
 
 def error(msg):
-    print('  [\033[91mx\033[0m] ' + msg)
+    print(_ERR_PREFIX + msg)
     exit(1)
 
 def success(msg):
-    print('  [\033[92mo\033[0m] ' + msg)
+    print(_OK_PREFIX + msg)
 
-def load_json_lines(f):
-    if not exists(f):
+def load_json_lines(f, fields=None):
+    try:
+        st = os.stat(f)
+    except OSError:
         error('The file "' + f + '" does not exist.')
 
     ret = []
     num = 1
     
-    if isdir(f):
-        f = glob(f + '/*.json*')
+    if S_ISDIR(st.st_mode):
+        with os.scandir(f) as it:
+            f = [e.path for e in it if not e.name.startswith('.') and '.json' in e.name]
         
         if len(f) != 1:
             error('The input is an directory that contains multiple json files. Please create only a single json file. Got ' + str(f))
         
         f = f[0]
     
-    with open(f, 'r') as inp:
+    with open(f, 'rb') as inp:
         for l in inp:
             try:
-                ret += [json.loads(l)]
+                i = json_loads(l)
             except:
-                error('Invalid line ' + str(num) + ' in "' + f + '" with content: ' + l.strip())
+                error('Invalid line ' + str(num) + ' in "' + f + '" with content: ' + l.decode('utf-8', 'replace').strip())
+
+            if fields and all(k in i for k in fields):
+                i = {k: i[k] for k in fields}
+
+            ret.append(i)
             num += 1
 
     success('The file ' + f + ' is in JSONL format.')
@@ -52,57 +67,47 @@ def load_json_lines(f):
 def spoiler_predictions_to_map(l, error=error, field='spoilerType'):
     if l is None or len(l) == 0:
         error('Spoiler predictions are empty.')
-    uuids = []
+    ret = {}
 
     for i in l:
-        if 'uuid' not in i.keys() or field not in i.keys():
+        try:
+            uuid = i['uuid']
+            v = i[field]
+        except KeyError:
             error(f'Spoiler predictions do not have all required fields. Expected fields "uuid" and "{field}". Got: ' + str(i))
             return
-        uuids += [i['uuid']]
 
-    if len(l) != len(set(uuids)):
-            error('Spoiler predictions have dupliates. I found ' + str(len(l)) + ' entries but only ' + str(len(set(uuids))) + ' unique uuids.')
+        if uuid in ret:
+            error('Spoiler predictions have duplicates. The uuid "' + str(uuid) + '" occurs more than once.')
             return
 
-    success('Spoiler predictions have correct format. Found ' + str(len(l)))
-    return {i['uuid']: i[field] if type(i[field]) is not list else i[field][0] for i in l}
-
-def normalize_spoiler_generation(i, error, expected_spoiler_type=None):
-    if 'uuid' not in i or 'spoiler' not in i:
-        error('Spoiler generation does not have all required fields. Expected fields are uuid and spoiler. Got: ' + str(i))
-        return
-
-    if expected_spoiler_type and expected_spoiler_type not in i['tags']:
-    	return True
+        if type(v) is list:
+            v = v[0]
+        ret[uuid] = sys.intern(v) if type(v) is str else v
 
-    return {i['uuid']: i['spoiler']}
+    success('Spoiler predictions have correct format. Found ' + str(len(l)))
+    return ret
 
 def spoiler_generations_to_map(l, error=error, expected_spoiler_type=None):
     if l is None or len(l) == 0:
         error('Spoiler predictions are empty.')
-    uuids = []
+    ret = {}
 
-    for i in deepcopy(l):
-        i = normalize_spoiler_generation(i, error, expected_spoiler_type)
-        if not i:
+    for i in l:
+        if 'uuid' not in i or 'spoiler' not in i:
+            error('Spoiler generation does not have all required fields. Expected fields are uuid and spoiler. Got: ' + str(i))
             return
-        elif i is True:
+
+        if expected_spoiler_type and expected_spoiler_type not in i['tags']:
             continue
-        uuids += list(i.keys())
 
-    if not expected_spoiler_type and len(l) != len(set(uuids)):
-            error('Spoiler generations have dupliates. I found ' + str(len(l)) + ' entries but only ' + str(len(set(uuids))) + ' unique uuids.')
+        if i['uuid'] in ret:
+            error('Spoiler generations have duplicates. The uuid "' + str(i['uuid']) + '" occurs more than once.')
+            return
 
-    l = [normalize_spoiler_generation(i, error, expected_spoiler_type) for i in l]
-    l = [i for i in l if i and i is not True]
+        ret[i['uuid']] = i['spoiler']
 
-    success('Spoiler generations have correct format. Found ' + str(len(l)))
-    ret = {}
-    for i in l:
-        for k, v in i.items():
-            assert k not in ret
-            ret[k] = v
-    
+    success('Spoiler generations have correct format. Found ' + str(len(ret)))
     return ret
 
 
@@ -118,23 +123,28 @@ def parse_args():
 
     return parser.parse_args()
 
-def to_prototext(d):
-    ret = ''
-    
+def write_prototext(f, d):
+    sep = ''
     for k, v in d.items():
-        ret += 'measure{\n  key: "' + str(k) + '"\n  value: "' + str(v) + '"\n}\n'
-    
-    return ret.strip()
+        f.write(f'{sep}measure{{\n  key: "{k}"\n  value: "{v}"\n}}')
+        sep = '\n'
 
 def filter_to(y_true, y_pred, filter_value):
     y_true_filtered, y_pred_filtered = [], []
     for i in range(len(y_true)):
         if y_true[i] == filter_value or y_pred[i] == filter_value:
-            y_true_filtered += [1 if y_true[i] == filter_value else 0]
-            y_pred_filtered += [1 if y_pred[i] == filter_value else 0]
+            y_true_filtered.append(1 if y_true[i] == filter_value else 0)
+            y_pred_filtered.append(1 if y_pred[i] == filter_value else 0)
     
     return (y_true_filtered, y_pred_filtered)
 
+def balanced_accuracy(y_true, y_pred):
+    classes, class_index = np.unique(np.asarray(y_true), return_inverse=True)
+    hits = np.asarray(y_true) == np.asarray(y_pred)
+    recall = np.bincount(class_index, weights=hits, minlength=len(classes)) / np.bincount(class_index, minlength=len(classes))
+
+    return float(recall.mean())
+
 def precision_on(y_true, y_pred, filter_value):
     y_true_filtered, y_pred_filtered = filter_to(y_true, y_pred, filter_value)
 
@@ -153,24 +163,20 @@ def f1_on(y_true, y_pred, filter_value):
 
 
 def create_protobuf_for_task_1(actual, expected):
-    keys = sorted(actual.keys())
+    y_true, y_pred = [], []
     missing_predictions = 0
-    
-    y_true = []
-    y_pred = []
-    
-    for k in keys:
-        y_true += [expected[k]]
-        
-        if k in actual:
-            y_pred += [actual[k]]
-        else:
+
+    for k, v in expected.items():
+        y_true.append(v)
+        p = actual.get(k)
+        if p is None:
             missing_predictions += 1
-            y_pred += ['']
+            p = ''
+        y_pred.append(p)
 
     return {
-        "result-size": len(keys),
-        'balanced-accuracy': balanced_accuracy_score(y_true, y_pred),
+        "result-size": len(y_true),
+        'balanced-accuracy': balanced_accuracy(y_true, y_pred),
         'precision-for-phrase-spoilers': precision_on(y_true, y_pred, 'phrase'),
         'recall-for-phrase-spoilers': recall_on(y_true, y_pred, 'phrase'),
         'f1-for-phrase-spoilers': f1_on(y_true, y_pred, 'phrase'),
@@ -188,15 +194,15 @@ def eval_task_1(input_run, ground_truth_classes, output_file):
     ret = None
     if ground_truth_classes == None:
         success('No ground-truth is passed. I tested the input run and the input run is valid.')
-        ret = to_prototext({"result-size": len(input_run.keys())})
+        ret = {"result-size": len(input_run.keys())}
         
     else:
         ground_truth_classes = spoiler_predictions_to_map(ground_truth_classes, field='tags')
-        ret = to_prototext(create_protobuf_for_task_1(input_run, ground_truth_classes))
+        ret = create_protobuf_for_task_1(input_run, ground_truth_classes)
 
     if output_file:
         with open(output_file, 'w') as f:
-            f.write(ret)
+            write_prototext(f, ret)
 
 def bleu_score(truth, prediction):
     """
@@ -286,17 +292,17 @@ def create_protobuf_for_task_2(actual, expected):
         if type(exp) is list:
             exp = ' '.join(exp)
         
-        y_true += [exp.replace('\n', ' ').strip()]
+        y_true.append(exp.replace('\n', ' ').strip())
         
         if k in actual:
             act = actual[k]
             if type(act) is list:
                 act = ' '.join(act)
             
-            y_pred += [act.replace('\n', ' ').strip()]
+            y_pred.append(act.replace('\n', ' ').strip())
         else:
             missing_predictions += 1
-            y_pred += ['']
+            y_pred.append('')
 
     return {
         "result-size": len(keys),
@@ -309,29 +315,27 @@ def create_protobuf_for_task_2(actual, expected):
 def eval_task_2(input_run, ground_truth_classes, ground_truth_spoilers, output_file):
     input_run = spoiler_generations_to_map(input_run)
     if ground_truth_spoilers == None:
-        ret = to_prototext({"result-size": len(input_run.keys())})
+        ret = {"result-size": len(input_run.keys())}
         success('No ground-truth is passed. I tested the input run and the input run is valid.')
     else:
         ret = {}
         for (display_name, tag_name) in [('all-spoilers', None), ('phrase-spoilers', 'phrase'), ('passage-spoilers', 'passage'), ('multi-spoilers', 'multi')]:
             print('Run evaluation for ' + display_name)
-            filtered_ground_truth_spoilers = spoiler_generations_to_map(deepcopy(ground_truth_spoilers), expected_spoiler_type=tag_name)
+            filtered_ground_truth_spoilers = spoiler_generations_to_map(ground_truth_spoilers, expected_spoiler_type=tag_name)
 
             for k,v in create_protobuf_for_task_2(input_run, filtered_ground_truth_spoilers).items():
                 ret[k + '-' + display_name] = v
 
-        ret = to_prototext(ret)
-
 	
     if output_file:
         with open(output_file, 'w') as f:
-            f.write(ret)
+            write_prototext(f, ret)
 
 if __name__ == '__main__':
     args = parse_args()
-    input_run = load_json_lines(args.input_run)
-    ground_truth_classes = None if not args.ground_truth_classes else load_json_lines(args.ground_truth_classes)
-    ground_truth_spoilers = None if not args.ground_truth_spoilers else load_json_lines(args.ground_truth_spoilers)
+    input_run = load_json_lines(args.input_run, ['uuid', 'spoilerType'] if args.task == '1' else ['uuid', 'spoiler'])
+    ground_truth_classes = None if not args.ground_truth_classes else load_json_lines(args.ground_truth_classes, ['uuid', 'tags'])
+    ground_truth_spoilers = None if not args.ground_truth_spoilers else load_json_lines(args.ground_truth_spoilers, ['uuid', 'spoiler', 'tags'])
 
     if args.task == '1':
         eval_task_1(input_run, ground_truth_classes, args.output_prototext)
@@ -1,4 +1,5 @@
 import importlib
+from sklearn.metrics import balanced_accuracy_score
 cse = importlib.import_module('clickbait-spoiling-eval')
 
 
@@ -11,6 +12,13 @@ def test_input_task_1_suceeds():
 def test_input_task_2_fails():
     assert None == cse.spoiler_predictions_to_map(cse.load_json_lines(('test-resources/valid-input-task-2.jsonl')), lambda x: None)
 
+def test_input_task_2_fails_with_the_submitted_record():
+    errors = []
+    inp = cse.load_json_lines('test-resources/valid-input-task-2.jsonl', ['uuid', 'spoilerType'])
+
+    assert None == cse.spoiler_predictions_to_map(inp, errors.append)
+    assert 'some spoiler 1' in errors[0]
+
 def test_input_for_task_1_can_be_extracted_from_ground_truth():
     expected = {"1": "passage",  "2": "phrase", "3": "multi"}
     inp = [{"uuid": "1", "tags": ["passage"]}, {"uuid": "2", "tags": ["phrase"]}, {"uuid": "3", "tags": ["multi"]}]
@@ -18,6 +26,11 @@ def test_input_for_task_1_can_be_extracted_from_ground_truth():
 
     assert actual == expected
 
+def test_input_for_task_1_with_duplicates_fails():
+    inp = [{"uuid": "1", "tags": ["passage"]}, {"uuid": "2", "tags": ["phrase"]}, {"uuid": "1", "tags": ["multi"]}]
+
+    assert None == cse.spoiler_predictions_to_map(inp, lambda x: None, 'tags')
+
 def test_evaluation_protobuff_for_perfect_result():
     expected = {"result-size": 3, "balanced-accuracy": 1.0,
                 "precision-for-phrase-spoilers": 1.0, "recall-for-phrase-spoilers": 1.0,
@@ -124,3 +137,21 @@ def test_evaluation_protobuff_for_approach_that_alwayas_predicts_multi():
     print('Actual: ' + str(actual))
 
     assert actual == expected
+
+def test_balanced_accuracy_counts_unknown_predictions_as_wrong():
+    y_true = ['passage', 'passage', 'phrase', 'phrase', 'multi', 'passage']
+    y_pred = ['passage', '', 'phrase', 'multi', '', 'phrase']
+
+    assert cse.balanced_accuracy(y_true, y_pred) == balanced_accuracy_score(y_true, y_pred)
+
+def test_evaluation_protobuff_counts_missing_predictions():
+    a = cse.spoiler_predictions_to_map([{"uuid": "1", "tags": ["passage"]}, {"uuid": "2", "tags": ["phrase"]}], lambda x: None, 'tags')
+    b = cse.spoiler_predictions_to_map(
+        [{"uuid": "1", "tags": ["passage"]}, {"uuid": "2", "tags": ["phrase"]}, {"uuid": "3", "tags": ["multi"]}],
+        lambda x: None, 'tags')
+
+    actual = cse.create_protobuf_for_task_1(a, b)
+
+    assert actual['result-size'] == 3
+    assert actual['missing-predictions'] == 1
+    assert actual['balanced-accuracy'] == 2 / 3
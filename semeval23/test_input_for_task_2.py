@@ -33,6 +33,11 @@ def test_input_task_2_can_be_filtered_for_phrase():
 
     assert expected == actual
 
+def test_input_task_2_with_duplicates_fails():
+    inp = [{"uuid": "1", "spoiler": "some spoiler 1"}, {"uuid": "1", "spoiler": "some spoiler 2"}]
+
+    assert None == cse.spoiler_generations_to_map(inp, lambda x: None)
+
 def test_evaluation_protobuff_for_perfect_result():
     expected = {
         'result-size': 2,